@@ -11,7 +11,7 @@ from typing import Dict, Mapping, NamedTuple, Sequence
 from util import NORMALIZED_MACHINE_NAME
 
 KERNEL_ORG_COMPILER_VERSION = "12.2.0"
-VMTEST_KERNEL_VERSION = 21
+VMTEST_KERNEL_VERSION = 22
 
 
 BASE_KCONFIG = """
@@ -42,8 +42,14 @@ CONFIG_TMPFS=y
 CONFIG_TMPFS_XATTR=y
 CONFIG_VIRTIO_CONSOLE=y
 CONFIG_VIRTIO_PCI=y
-CONFIG_HW_RANDOM=m
-CONFIG_HW_RANDOM_VIRTIO=m
+# Built in so that the guest gets entropy without loading modules.
+CONFIG_HW_RANDOM=y
+CONFIG_HW_RANDOM_VIRTIO=y
+
+# For sharing the root filesystem via virtiofs when the host supports it. This
+# is optional; vmtest falls back to 9pfs.
+CONFIG_FUSE_FS=y
+CONFIG_VIRTIO_FS=y
 
 # Lots of stuff expect Unix sockets.
 CONFIG_UNIX=y
@@ -1,14 +1,21 @@
 # Copyright (c) Meta Platforms, Inc. and affiliates.
 # SPDX-License-Identifier: LGPL-2.1-or-later
 
+import contextlib
+import fcntl
+import functools
 import os
 from pathlib import Path
 import re
+import select
 import shlex
+import shutil
 import socket
+import string
 import subprocess
 import sys
 import tempfile
+from typing import Any, List, Optional, Tuple
 
 from util import nproc, out_of_date
 from vmtest.config import HOST_ARCHITECTURE, Kernel
@@ -19,8 +26,33 @@ from vmtest.download import (
     download_kernel_argparse_type,
 )
 
+# 9pfs message size. This bounds the payload of each read and write request,
+# so bigger means fewer round trips. QEMU accepts up to 4 MB, but Linux's
+# virtio transport limits it to 125 pages (about 500 KB with 4 KB pages, 8 MB
+# with 64 KB pages) and clamps anything larger, so most guests get less.
+_9PFS_MSIZE = 4 * 1024 * 1024
+
+# Number of virtual CPUs to give the VM. Limit the number of cores to 8,
+# otherwise we can reach an OOM troubles.
+_SMP_CPUS = min(nproc(), 8)
+
+# Guest RAM size in MB.
+_MEMORY_MB = 2048
+
+# Supported 9pfs cache modes (fscache needs CONFIG_9P_FSCACHE, which vmtest
+# kernels don't enable).
+_9PFS_CACHE_MODES = ("none", "loose", "mmap")
+
+
+class _InitTemplate(string.Template):
+    # The script is full of shell variables, so use a delimiter that the shell
+    # doesn't care about.
+    delimiter = "@"
+
+
 # Script run as init in the virtual machine.
-_INIT_TEMPLATE = r"""#!/bin/sh
+_INIT_TEMPLATE = _InitTemplate(
+    r"""#!/bin/sh
 
 # Having /proc from the host visible in the guest can confuse some commands. In
 # particular, if BusyBox is configured with FEATURE_SH_STANDALONE, then busybox
@@ -32,7 +64,7 @@ _INIT_TEMPLATE = r"""#!/bin/sh
 set -eu
 
 export PATH="/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin"
-{kdump_needs_nosmp}
+@kdump_needs_nosmp
 
 trap 'poweroff -f' EXIT
 
@@ -80,22 +112,27 @@ umount -l /mnt
 
 # Load kernel modules.
 mkdir -p "/lib/modules/$RELEASE"
-mount --bind {kernel_dir} "/lib/modules/$RELEASE"
-for module in configs rng_core virtio_rng; do
-	modprobe "$module"
-done
+mount --bind @kernel_dir "/lib/modules/$RELEASE"
+# The virtio RNG driver is built in on recent vmtest kernels, in which case
+# modprobe does nothing for it.
+modprobe -a configs rng_core virtio_rng
 
-# Create static device nodes.
-grep -v '^#' "/lib/modules/$RELEASE/modules.devname" |
+# Create static device nodes. This avoids running anything other than mknod
+# per node where possible since it's on the boot path.
 while read -r module name node; do
+	case "$module" in
+	'#'*) continue ;;
+	esac
 	name="/dev/$name"
-	dev=${{node#?}}
-	major=${{dev%%:*}}
-	minor=${{dev##*:}}
-	type=${{node%"${{dev}}"}}
-	mkdir -p "$(dirname "$name")"
+	dev=${node#?}
+	major=${dev%%:*}
+	minor=${dev##*:}
+	type=${node%"${dev}"}
+	case "$name" in
+	/dev/*/*) mkdir -p "${name%/*}" ;;
+	esac
 	mknod "$name" "$type" "$major" "$minor"
-done
+done < "/lib/modules/$RELEASE/modules.devname"
 ln -s /proc/self/fd /dev/fd
 ln -s /proc/self/fd/0 /dev/stdin
 ln -s /proc/self/fd/1 /dev/stdout
@@ -115,7 +152,7 @@ ip link set lo up
 vport=
 for vport_dir in /sys/class/virtio-ports/*; do
 	if [ -r "$vport_dir/name" -a "$(cat "$vport_dir/name")" = "$VPORT_NAME" ]; then
-		vport="${{vport_dir#/sys/class/virtio-ports/}}"
+		vport="${vport_dir#/sys/class/virtio-ports/}"
 		break
 	fi
 done
@@ -124,15 +161,32 @@ if [ -z "$vport" ]; then
 	exit 1
 fi
 
-cd {cwd}
+# Run commands sent by the host. Each command is sent as its length in bytes
+# on one line followed by the command itself. We reply with a line containing
+# the exit status. The port must stay open while we wait for commands,
+# otherwise the guest drops anything that the host writes.
+cd @cwd
+exec 3<> "/dev/$vport"
+echo ready >&3
 set +e
-sh -c {command}
-rc=$?
-set -e
-
-echo "Exited with status $rc"
-echo "$rc" > "/dev/$vport"
+while read -r length <&3; do
+	command="$(head -c "$length" <&3)"
+	sh -c "$command" 3>&-
+	rc=$?
+	echo "Exited with status $rc"
+	echo "$rc" >&3
+done
 """
+)
+
+
+# Default CFLAGS used by automake.
+_DEFAULT_CFLAGS = ("-g", "-O2")
+
+
+def _split_flags(flags: str) -> List[str]:
+    # Flags are usually empty, so skip the shlex machinery in that case.
+    return shlex.split(flags) if flags else []
 
 
 def _compile(
@@ -145,17 +199,18 @@ def _compile(
     # This mimics automake: the order of the arguments allows for the default
     # flags to be overridden by environment variables, and we use the same
     # default CFLAGS.
+    env_cflags = os.getenv("CFLAGS")
     cmd = [
         os.getenv("CC", "cc"),
-        *shlex.split(CPPFLAGS),
-        *shlex.split(os.getenv("CPPFLAGS", "")),
-        *shlex.split(CFLAGS),
-        *shlex.split(os.getenv("CFLAGS", "-g -O2")),
-        *shlex.split(LDFLAGS),
-        *shlex.split(os.getenv("LDFLAGS", "")),
+        *_split_flags(CPPFLAGS),
+        *_split_flags(os.getenv("CPPFLAGS", "")),
+        *_split_flags(CFLAGS),
+        *(_DEFAULT_CFLAGS if env_cflags is None else _split_flags(env_cflags)),
+        *_split_flags(LDFLAGS),
+        *_split_flags(os.getenv("LDFLAGS", "")),
         *args,
-        *shlex.split(LIBADD),
-        *shlex.split(os.getenv("LIBS", "")),
+        *_split_flags(LIBADD),
+        *_split_flags(os.getenv("LIBS", "")),
     ]
     print(" ".join([shlex.quote(arg) for arg in cmd]))
     subprocess.check_call(cmd)
@@ -166,149 +221,512 @@ def _build_onoatimehack(dir: Path) -> Path:
 
     onoatimehack_so = dir / "onoatimehack.so"
     onoatimehack_c = (Path(__file__).parent / "onoatimehack.c").relative_to(Path.cwd())
-    if out_of_date(onoatimehack_so, onoatimehack_c):
-        _compile(
-            "-o",
-            str(onoatimehack_so),
-            str(onoatimehack_c),
-            CPPFLAGS="-D_GNU_SOURCE",
-            CFLAGS="-fPIC",
-            LDFLAGS="-shared",
-            LIBADD="-ldl",
-        )
+    # Parallel test runs may get here at the same time, so only let one of them
+    # build it, and replace it atomically so that a running QEMU never sees a
+    # partially written file.
+    with (dir / ".onoatimehack.lock").open("w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        if out_of_date(onoatimehack_so, onoatimehack_c):
+            tmp_onoatimehack_so = dir / "onoatimehack.so.tmp"
+            _compile(
+                "-o",
+                str(tmp_onoatimehack_so),
+                str(onoatimehack_c),
+                CPPFLAGS="-D_GNU_SOURCE",
+                CFLAGS="-fPIC",
+                LDFLAGS="-shared",
+                LIBADD="-ldl",
+            )
+            tmp_onoatimehack_so.rename(onoatimehack_so)
     return onoatimehack_so
 
 
-class LostVMError(Exception):
-    pass
+def _virtiofsd_help(path: str) -> bytes:
+    try:
+        return subprocess.run(
+            [path, "--help"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+        ).stdout
+    except OSError:
+        return b""
+
+
+@functools.lru_cache(maxsize=None)
+def _find_virtiofsd() -> Optional[str]:
+    # virtiofsd is usually installed outside of $PATH. The fallback locations
+    # may have the old C virtiofsd from QEMU, which takes different options, so
+    # only accept the Rust virtiofsd. We also need --readonly, which older
+    # versions of the Rust virtiofsd don't have.
+    for path in (
+        shutil.which("virtiofsd"),
+        "/usr/libexec/virtiofsd",
+        "/usr/lib/qemu/virtiofsd",
+    ):
+        if (
+            path is not None
+            and os.access(path, os.X_OK)
+            and all(
+                option in _virtiofsd_help(path)
+                for option in (b"--shared-dir", b"--readonly")
+            )
+        ):
+            return path
+    return None
 
 
-def run_in_vm(command: str, kernel: Kernel, root_dir: Path, build_dir: Path) -> int:
-    qemu_exe = "qemu-system-" + kernel.arch.name
-    match = re.search(
-        r"QEMU emulator version ([0-9]+(?:\.[0-9]+)*)",
-        subprocess.check_output([qemu_exe, "-version"], universal_newlines=True),
-    )
+def _kernel_has_virtiofs(kernel: Kernel) -> bool:
+    # Kernels built before virtiofs was added to the vmtest configuration don't
+    # have it.
+    try:
+        with (kernel.path / "modules.builtin").open() as f:
+            return any(line.rstrip("\n").endswith("/virtiofs.ko") for line in f)
+    except FileNotFoundError:
+        return False
+
+
+_QEMU_VERSION_RE = re.compile(rb"QEMU emulator version ([0-9]+(?:\.[0-9]+)*)")
+
+
+# The QEMU executables don't change while we're running, so only query them
+# once per process.
+@functools.lru_cache(maxsize=None)
+def _qemu_version(qemu_exe: str) -> Tuple[int, ...]:
+    match = _QEMU_VERSION_RE.search(subprocess.check_output([qemu_exe, "-version"]))
     if not match:
         raise Exception("could not determine QEMU version")
-    qemu_version = tuple(int(x) for x in match.group(1).split("."))
-
-    # QEMU's 9pfs O_NOATIME handling was fixed in 5.1.0. The fix was backported
-    # to 5.0.1.
-    env = os.environ.copy()
-    if qemu_version < (5, 0, 1):
-        onoatimehack_so = _build_onoatimehack(build_dir)
-        env["LD_PRELOAD"] = f"{str(onoatimehack_so)}:{env.get('LD_PRELOAD', '')}"
-
-    kvm_args = []
-    if HOST_ARCHITECTURE is not None and kernel.arch.name == HOST_ARCHITECTURE.name:
-        if os.access("/dev/kvm", os.R_OK | os.W_OK):
-            kvm_args = ["-cpu", "host", "-enable-kvm"]
-        else:
-            print(
-                "warning: /dev/kvm cannot be accessed; falling back to emulation",
-                file=sys.stderr,
-            )
+    return tuple(int(x) for x in match.group(1).split(b"."))
+
+
+@functools.lru_cache(maxsize=None)
+def _qemu_has_device(qemu_exe: str, device: str) -> bool:
+    return (
+        b'name "%s"' % device.encode()
+        in subprocess.run(
+            [qemu_exe, "-device", "help"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        ).stdout
+    )
 
-    virtfs_options = "security_model=none,readonly=on"
-    # multidevs was added in QEMU 4.2.0.
-    if qemu_version >= (4, 2):
-        virtfs_options += ",multidevs=remap"
-    _9pfs_mount_options = f"trans=virtio,cache=loose,msize={1024 * 1024}"
-
-    with tempfile.TemporaryDirectory(prefix="drgn-vmtest-") as temp_dir, socket.socket(
-        socket.AF_UNIX
-    ) as server_sock:
-        temp_path = Path(temp_dir)
-        socket_path = temp_path / "socket"
-        server_sock.bind(str(socket_path))
-        server_sock.listen()
-
-        init_path = temp_path / "init"
-
-        if root_dir == Path("/"):
-            host_virtfs_args = []
-            init = str(init_path.resolve())
-            host_dir_prefix = ""
+
+def _free_hugepages(size_kb: int) -> int:
+    # Return the number of huge pages available for new mappings if the default
+    # huge page size is size_kb, or 0 otherwise.
+    free = reserved = 0
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                if key == "HugePages_Free":
+                    free = int(value)
+                elif key == "HugePages_Rsvd":
+                    reserved = int(value)
+                elif key == "Hugepagesize" and value.split() != [str(size_kb), "kB"]:
+                    return 0
+    except FileNotFoundError:
+        pass
+    return free - reserved
+
+
+def _temp_dir_parent() -> Optional[str]:
+    # The temporary directory only holds the init script and sockets, so put it
+    # on a tmpfs if possible to avoid hitting the disk.
+    for dir in (os.environ.get("XDG_RUNTIME_DIR"), "/dev/shm"):
+        if dir and os.access(dir, os.W_OK | os.X_OK):
+            return dir
+    return None
+
+
+class LostVMError(Exception):
+    pass
+
+
+class _QEMUFailedError(LostVMError):
+    # QEMU exited with an error before the guest booted.
+    pass
+
+
+class VM:
+    # Virtual machine that is booted once and can then run multiple commands
+    # via VM.run(). This must be used as a context manager; the VM is powered
+    # off on exit.
+
+    def __init__(
+        self,
+        kernel: Kernel,
+        root_dir: Path,
+        build_dir: Path,
+        *,
+        cache_9pfs: str = "loose",
+    ) -> None:
+        self._kernel = kernel
+        self._root_dir = root_dir
+        self._build_dir = build_dir
+        # Cache mode for 9pfs mounts. The default, loose, is the fastest, and
+        # it's safe since the shares are read-only and overlaid with tmpfs.
+        # Other modes are mainly useful for comparison. This doesn't affect
+        # the root filesystem if it uses virtiofs.
+        if cache_9pfs not in _9PFS_CACHE_MODES:
+            raise ValueError(f"invalid 9pfs cache mode: {cache_9pfs!r}")
+        self._cache_9pfs = cache_9pfs
+        self._exit_stack = contextlib.ExitStack()
+        self._sock: Optional[socket.socket] = None
+        self._virtiofsd: "Optional[subprocess.Popen[bytes]]" = None
+        # Buffer of data received from the guest. Only the first _buf_len bytes
+        # are valid.
+        self._buf = bytearray(64)
+        self._buf_len = 0
+
+    def __enter__(self) -> "VM":
+        # If the host has enough 2 MB huge pages reserved, back guest memory
+        # with them and prefault it to avoid page faults and TLB misses while
+        # booting. This is opt-in by reserving huge pages via
+        # /proc/sys/vm/nr_hugepages. We attach the memory backend with
+        # -machine memory-backend, which was added in QEMU 5.0.
+        qemu_exe = "qemu-system-" + self._kernel.arch.name
+        if (
+            _qemu_version(qemu_exe) >= (5, 0)
+            and _free_hugepages(2048) * 2 >= _MEMORY_MB
+        ):
+            try:
+                self._start(hugepages=True)
+                return self
+            except _QEMUFailedError as e:
+                # We can't tell why QEMU failed, but the likeliest cause is that
+                # other VMs used up the huge pages between when we checked and
+                # when QEMU tried to allocate them. If it was something else,
+                # then it will fail again without them.
+                print(
+                    f"warning: {e} while using huge pages (possibly because they ran out); retrying without them",
+                    file=sys.stderr,
+                )
+        self._start(hugepages=False)
+        return self
+
+    def _start(self, hugepages: bool) -> None:
+        kernel = self._kernel
+        root_dir = self._root_dir
+
+        qemu_exe = "qemu-system-" + kernel.arch.name
+        qemu_version = _qemu_version(qemu_exe)
+
+        # QEMU's 9pfs O_NOATIME handling was fixed in 5.1.0. The fix was
+        # backported to 5.0.1.
+        env = os.environ.copy()
+        if qemu_version < (5, 0, 1):
+            onoatimehack_so = _build_onoatimehack(self._build_dir)
+            env["LD_PRELOAD"] = f"{str(onoatimehack_so)}:{env.get('LD_PRELOAD', '')}"
+
+        kvm_args = []
+        kvm_cmdline = ""
+        if HOST_ARCHITECTURE is not None and kernel.arch.name == HOST_ARCHITECTURE.name:
+            if os.access("/dev/kvm", os.R_OK | os.W_OK):
+                cpu = "host"
+                if kernel.arch.name == "x86_64":
+                    # We never migrate the VM, so don't mask out CPUID features
+                    # for migration compatibility. This option only exists on
+                    # x86, and we only rely on it from QEMU 3.0.
+                    if qemu_version >= (3, 0):
+                        cpu += ",migratable=off"
+                    # The TSC is stable under KVM, so skip the clocksource
+                    # watchdog and the IO-APIC timer check while booting. Also
+                    # seed the RNG from RDRAND instead of waiting for
+                    # virtio-rng (kernels before 4.19 ignore this).
+                    kvm_cmdline = " tsc=reliable no_timer_check random.trust_cpu=on"
+                kvm_args = ["-cpu", cpu, "-enable-kvm"]
+            else:
+                print(
+                    "warning: /dev/kvm cannot be accessed; falling back to emulation",
+                    file=sys.stderr,
+                )
+
+        virtfs_options = "security_model=none,readonly=on"
+        # multidevs was added in QEMU 4.2.0.
+        if qemu_version >= (4, 2):
+            virtfs_options += ",multidevs=remap"
+        _9pfs_mount_options = (
+            f"trans=virtio,cache={self._cache_9pfs},msize={_9PFS_MSIZE}"
+        )
+
+        # virtiofs is much faster than 9pfs, so use it for the root filesystem if
+        # the kernel, QEMU, and virtiofsd all support it.
+        virtiofsd = None
+        if _kernel_has_virtiofs(kernel):
+            virtiofsd = _find_virtiofsd()
+            if virtiofsd is not None and not _qemu_has_device(
+                qemu_exe, "vhost-user-fs-pci"
+            ):
+                virtiofsd = None
+
+        memory_backend_options = []
+        if hugepages:
+            memory_backend_options.append("hugetlb=on,hugetlbsize=2M,prealloc=on")
+        if virtiofsd is not None:
+            # vhost-user requires guest memory to be shared with virtiofsd.
+            memory_backend_options.append("share=on")
+        if memory_backend_options:
+            memory_backend = (
+                f"memory-backend-memfd,id=mem,size={_MEMORY_MB}M,"
+                + ",".join(memory_backend_options)
+            )
+            memory_args = ["-object", memory_backend]
+            # Not every machine type supports -numa, so use -machine
+            # memory-backend if QEMU has it (since 5.0). Huge pages are only
+            # used in that case, but vhost-user-fs-pci has been around since
+            # QEMU 4.2, so fall back to -numa for virtiofs.
+            if qemu_version >= (5, 0):
+                memory_args += ["-machine", "memory-backend=mem"]
+            else:
+                memory_args += ["-numa", "node,memdev=mem"]
         else:
-            host_virtfs_args = [
-                "-virtfs",
-                f"local,path=/,mount_tag=host,{virtfs_options}",
-            ]
-            init = f'/bin/sh -- -c "/bin/mount -t tmpfs tmpfs /tmp && /bin/mkdir /tmp/host && /bin/mount -t 9p -o {_9pfs_mount_options},ro host /tmp/host && . /tmp/host{init_path.resolve()}"'
-            host_dir_prefix = "/host"
-
-        with init_path.open("w") as init_file:
-            init_file.write(
-                _INIT_TEMPLATE.format(
-                    cwd=shlex.quote(host_dir_prefix + os.getcwd()),
-                    kernel_dir=shlex.quote(
-                        host_dir_prefix + str(kernel.path.resolve())
-                    ),
-                    command=shlex.quote(command),
-                    kdump_needs_nosmp="" if kvm_args else "export KDUMP_NEEDS_NOSMP=1",
+            memory_args = []
+
+        with contextlib.ExitStack() as exit_stack:
+            temp_path = Path(
+                exit_stack.enter_context(
+                    tempfile.TemporaryDirectory(
+                        prefix="drgn-vmtest-", dir=_temp_dir_parent()
+                    )
                 )
             )
-        init_path.chmod(0o755)
+            server_sock = exit_stack.enter_context(socket.socket(socket.AF_UNIX))
+            socket_path = temp_path / "socket"
+            server_sock.bind(str(socket_path))
+            server_sock.listen()
+
+            init_path = temp_path / "init"
+
+            virtiofsd_proc = None
+            if virtiofsd is None:
+                root_fs_args = [
+                    "-virtfs",
+                    f"local,id=root,path={root_dir},mount_tag=/dev/root,{virtfs_options}",
+                ]
+                root_fs_cmdline = f"rootfstype=9p rootflags={_9pfs_mount_options}"
+            else:
+                # Listen on the socket ourselves so that it is ready before QEMU
+                # tries to connect to it. Only virtiofsd keeps it open after
+                # this so that if virtiofsd dies, QEMU fails to connect instead
+                # of hanging in our listen backlog.
+                virtiofs_socket_path = temp_path / "virtiofs.socket"
+                with socket.socket(socket.AF_UNIX) as virtiofs_sock:
+                    virtiofs_sock.bind(str(virtiofs_socket_path))
+                    virtiofs_sock.listen()
+                    virtiofsd_proc = exit_stack.enter_context(
+                        subprocess.Popen(
+                            [
+                                virtiofsd,
+                                f"--fd={virtiofs_sock.fileno()}",
+                                f"--shared-dir={root_dir}",
+                                "--cache=auto",
+                                "--sandbox=none",
+                                "--announce-submounts",
+                                "--readonly",
+                            ],
+                            pass_fds=(virtiofs_sock.fileno(),),
+                        )
+                    )
+                # virtiofsd exits once QEMU disconnects, but make sure that it
+                # doesn't outlive us if QEMU never connected.
+                exit_stack.callback(virtiofsd_proc.terminate)
+                root_fs_args = [
+                    # fmt: off
+                    "-chardev", f"socket,id=root,path={virtiofs_socket_path}",
+                    "-device", "vhost-user-fs-pci,chardev=root,tag=/dev/root",
+                    # fmt: on
+                ]
+                root_fs_cmdline = "rootfstype=virtiofs"
+
+            if root_dir == Path("/"):
+                host_virtfs_args = []
+                init = str(init_path.resolve())
+                host_dir_prefix = ""
+            else:
+                host_virtfs_args = [
+                    "-virtfs",
+                    f"local,path=/,mount_tag=host,{virtfs_options}",
+                ]
+                init = f'/bin/sh -- -c "/bin/mount -t tmpfs tmpfs /tmp && /bin/mkdir /tmp/host && /bin/mount -t 9p -o {_9pfs_mount_options},ro host /tmp/host && . /tmp/host{init_path.resolve()}"'
+                host_dir_prefix = "/host"
+
+            init_fd = os.open(init_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o755)
+            try:
+                os.write(
+                    init_fd,
+                    _INIT_TEMPLATE.substitute(
+                        cwd=shlex.quote(host_dir_prefix + os.getcwd()),
+                        kernel_dir=shlex.quote(
+                            host_dir_prefix + str(kernel.path.resolve())
+                        ),
+                        kdump_needs_nosmp=""
+                        if kvm_args
+                        else "export KDUMP_NEEDS_NOSMP=1",
+                    ).encode(),
+                )
+            finally:
+                os.close(init_fd)
 
-        with subprocess.Popen(
-            [
-                # fmt: off
-                qemu_exe, *kvm_args,
+            qemu = exit_stack.enter_context(
+                subprocess.Popen(
+                    [
+                        # fmt: off
+                        qemu_exe, *kvm_args,
 
-                # Limit the number of cores to 8, otherwise we can reach an OOM troubles.
-                "-smp", str(min(nproc(), 8)), "-m", "2G",
+                        # A single socket with one thread per core keeps the
+                        # guest topology simple.
+                        "-smp", f"{_SMP_CPUS},cores={_SMP_CPUS},threads=1,sockets=1",
+                        "-m", f"{_MEMORY_MB}M", *memory_args,
 
-                "-display", "none", "-serial", "mon:stdio",
+                        "-display", "none", "-serial", "mon:stdio",
 
-                # This along with -append panic=-1 ensures that we exit on a
-                # panic instead of hanging.
-                "-no-reboot",
+                        # This along with -append panic=-1 ensures that we exit on a
+                        # panic instead of hanging.
+                        "-no-reboot",
 
-                "-virtfs",
-                f"local,id=root,path={root_dir},mount_tag=/dev/root,{virtfs_options}",
-                *host_virtfs_args,
+                        *root_fs_args,
+                        *host_virtfs_args,
 
-                "-device", "virtio-rng",
+                        "-device", "virtio-rng",
 
-                "-device", "virtio-serial",
-                "-chardev", f"socket,id=vmtest,path={socket_path}",
-                "-device",
-                "virtserialport,chardev=vmtest,name=com.osandov.vmtest.0",
+                        "-device", "virtio-serial",
+                        "-chardev", f"socket,id=vmtest,path={socket_path}",
+                        "-device",
+                        "virtserialport,chardev=vmtest,name=com.osandov.vmtest.0",
 
-                *kernel.arch.qemu_options,
+                        *kernel.arch.qemu_options,
 
-                "-kernel", str(kernel.path / "vmlinuz"),
-                "-append",
-                f"rootfstype=9p rootflags={_9pfs_mount_options} ro console={kernel.arch.qemu_console},115200 panic=-1 crashkernel=256M init={init}",
-                # fmt: on
-            ],
-            env=env,
-        ):
-            server_sock.settimeout(5)
-            try:
-                sock = server_sock.accept()[0]
-            except socket.timeout:
-                raise LostVMError(
-                    f"QEMU did not connect within {server_sock.gettimeout()} seconds"
+                        "-kernel", str(kernel.path / "vmlinuz"),
+                        "-append",
+                        f"{root_fs_cmdline} ro console={kernel.arch.qemu_console},115200 panic=-1 crashkernel=256M{kvm_cmdline} init={init}",
+                        # fmt: on
+                    ],
+                    env=env,
                 )
+            )
+
             try:
-                status_buf = bytearray()
+                # QEMU's connection is queued on the listening socket even if
+                # it connects before we call accept(). QEMU can take a while to
+                # start (e.g., when preallocating memory), so instead of giving
+                # up after a fixed time, only give up if it exits without
+                # connecting.
+                server_sock.settimeout(1)
                 while True:
                     try:
-                        buf = sock.recv(4)
-                    except ConnectionResetError:
-                        buf = b""
-                    if not buf:
+                        sock = server_sock.accept()[0]
                         break
-                    status_buf.extend(buf)
-            finally:
-                sock.close()
-        if not status_buf:
-            raise LostVMError("VM did not return status")
-        if status_buf[-1] != ord("\n") or not status_buf[:-1].isdigit():
-            raise LostVMError(f"VM returned invalid status: {repr(status_buf)[11:-1]}")
-        return int(status_buf)
+                    except socket.timeout:
+                        if qemu.poll() is not None:
+                            raise LostVMError(
+                                f"QEMU exited with status {qemu.returncode} without connecting"
+                            )
+                # Closing the socket tells the guest to power off.
+                exit_stack.enter_context(sock)
+                # The timeout only applies to QEMU connecting; commands can take
+                # arbitrarily long.
+                sock.setblocking(True)
+                self._sock = sock
+                self._virtiofsd = virtiofsd_proc
+
+                line = self._read_line("handshake")
+                if line != b"ready":
+                    raise LostVMError(
+                        f"VM returned invalid handshake: {repr(line)[11:-1]}"
+                    )
+            except BaseException as e:
+                self._sock = None
+                self._virtiofsd = None
+                self._buf_len = 0
+                # If QEMU failed by itself, it is already exiting. Otherwise,
+                # don't wait for it to exit if it's stuck.
+                status: Optional[int]
+                try:
+                    status = qemu.wait(timeout=1)
+                except subprocess.TimeoutExpired:
+                    qemu.kill()
+                    status = None
+                if status is not None and status > 0 and isinstance(e, LostVMError):
+                    raise _QEMUFailedError(
+                        f"QEMU exited with status {status} before the VM booted"
+                    ) from e
+                raise
+
+            self._exit_stack = exit_stack.pop_all()
+
+    def __exit__(self, exc_type: Any, exc_value: Any, traceback: Any) -> None:
+        self._sock = None
+        self._virtiofsd = None
+        self._exit_stack.close()
+
+    def _read_line(self, what: str) -> bytearray:
+        assert self._sock is not None
+        while True:
+            i = self._buf.find(b"\n", 0, self._buf_len)
+            if i >= 0:
+                line = self._buf[:i]
+                remaining = self._buf_len - i - 1
+                self._buf[:remaining] = self._buf[i + 1 : self._buf_len]
+                self._buf_len = remaining
+                return line
+            if self._buf_len == len(self._buf):
+                self._buf.extend(bytes(64))
+            # QEMU gets stuck if virtiofsd dies, so don't wait forever in that
+            # case.
+            while not select.select([self._sock], [], [], 1)[0]:
+                if self._virtiofsd is not None and self._virtiofsd.poll() is not None:
+                    raise LostVMError(
+                        f"virtiofsd exited with status {self._virtiofsd.returncode}"
+                    )
+            try:
+                n = self._sock.recv_into(memoryview(self._buf)[self._buf_len :])
+            except ConnectionResetError:
+                n = 0
+            if n == 0:
+                if self._buf_len:
+                    raise LostVMError(
+                        f"VM returned invalid {what}: {repr(self._buf[:self._buf_len])[11:-1]}"
+                    )
+                raise LostVMError(f"VM did not return {what}")
+            self._buf_len += n
+
+    def _send(self, data: bytes) -> None:
+        assert self._sock is not None
+        try:
+            self._sock.sendall(data)
+        except (BrokenPipeError, ConnectionResetError):
+            raise LostVMError("VM exited before receiving command")
+
+    def run(self, command: str) -> int:
+        if self._sock is None:
+            raise ValueError("VM is not running")
+        command_bytes = command.encode()
+        request = b"%d\n%s" % (len(command_bytes), command_bytes)
+        self._send(request)
+        while True:
+            status = self._read_line("status")
+            # If the VM rebooted while running the command (e.g., because the
+            # command crashed the kernel to test kdump), then the init in the
+            # new kernel is waiting for a command. Run it again there, which is
+            # what running the command in init directly would do.
+            if status == b"ready":
+                self._send(request)
+                continue
+            if not status.isdigit():
+                raise LostVMError(f"VM returned invalid status: {repr(status)[11:-1]}")
+            return int(status)
+
+
+def run_in_vm(
+    command: str,
+    kernel: Kernel,
+    root_dir: Path,
+    build_dir: Path,
+    *,
+    cache_9pfs: str = "loose",
+) -> int:
+    with VM(kernel, root_dir, build_dir, cache_9pfs=cache_9pfs) as vm:
+        return vm.run(command)
 
 
 if __name__ == "__main__":
@@ -356,6 +774,13 @@ if __name__ == "__main__":
         type=Path,
         help="directory to use as root directory in VM",
     )
+    parser.add_argument(
+        "--9pfs-cache",
+        dest="cache_9pfs",
+        choices=_9PFS_CACHE_MODES,
+        default="loose",
+        help="cache mode for 9pfs mounts (no effect on the root filesystem if it uses virtiofs)",
+    )
     parser.add_argument(
         "command",
         type=str,
@@ -378,7 +803,15 @@ if __name__ == "__main__":
 
     try:
         command = " ".join(args.command) if args.command else "sh -i"
-        sys.exit(run_in_vm(command, kernel, args.root_directory, args.directory))
+        sys.exit(
+            run_in_vm(
+                command,
+                kernel,
+                args.root_directory,
+                args.directory,
+                cache_9pfs=args.cache_9pfs,
+            )
+        )
     except LostVMError as e:
         print("error:", e, file=sys.stderr)
         sys.exit(args.lost_status)